@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Measures the memory used to read a large CONLL file with each of the
+readers in util.
+
+Every reader runs in its own process and reports how much its resident
+set grew while it read the file. Anonymous memory (the heap) and
+file-backed memory are reported separately. Linux only, as it reads /proc.
+"""
+
+import os
+import sys
+import time
+import subprocess
+
+from util import iter_conll, read_conll_doc, write_conll
+
+def rss():
+    """
+    Returns the anonymous and file-backed resident memory of this process, in KB.
+    """
+    ret = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            key, _, value = line.partition(":")
+            if key in ("RssAnon", "RssFile"):
+                ret[key] = int(value.split()[0])
+    return ret["RssAnon"], ret["RssFile"]
+
+def read_doc(path):
+    with open(path) as f:
+        for sentence in read_conll_doc(f.read()):
+            yield sentence
+
+def read_list(path):
+    with open(path) as f:
+        for sentence in list(iter_conll(f)):
+            yield sentence
+
+def read_stream(path):
+    with open(path) as f:
+        yield from iter_conll(f)
+
+READERS = {
+    "read_conll_doc": read_doc,
+    "list(iter_conll)": read_list,
+    "iter_conll": read_stream,
+    }
+
+def generate(path, n_sentences):
+    """
+    Write @n_sentences sentences of 20 tokens each to @path.
+    """
+    sentence = [["word{}".format(i), "lemma{}".format(i), "NN", "O"] for i in range(20)]
+    with open(path, "w") as f:
+        for _ in range(n_sentences):
+            write_conll(f, sentence)
+
+def measure(reader, path):
+    """
+    Read @path with @reader and print the growth in resident memory.
+    """
+    anon, file_ = rss()
+    peak_anon, peak_file = anon, file_
+    start = time.time()
+    for i, _ in enumerate(READERS[reader](path)):
+        if i % 10000 == 0:
+            anon_, file__ = rss()
+            peak_anon, peak_file = max(peak_anon, anon_), max(peak_file, file__)
+    anon_, file__ = rss()
+    peak_anon, peak_file = max(peak_anon, anon_), max(peak_file, file__)
+    print("{:<20}{:>12}{:>12}{:>10.1f}".format(reader, peak_anon - anon, peak_file - file_, time.time() - start))
+
+def do_command(args):
+    if args.reader is not None:
+        measure(args.reader, args.path)
+        return
+
+    if not os.path.exists(args.path):
+        generate(args.path, args.sentences)
+    print("{}: {} MB".format(args.path, os.path.getsize(args.path) >> 20))
+    print("{:<20}{:>12}{:>12}{:>10}".format("reader", "anon KB", "file KB", "secs"))
+    for reader in args.readers or READERS:
+        # Readers that hold the whole file may run out of memory.
+        ret = subprocess.call([sys.executable, __file__, args.path, "--reader", reader])
+        if ret != 0:
+            print("{:<20}failed ({})".format(reader, ret))
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Measures the memory used by the CONLL readers')
+    parser.add_argument('path', help="CONLL file to read; generated if it doesn't exist")
+    parser.add_argument('--sentences', type=int, default=1000000, help="Number of sentences to generate")
+    parser.add_argument('--readers', nargs='+', choices=list(READERS), help="Only measure these readers")
+    parser.add_argument('--reader', choices=list(READERS), help=argparse.SUPPRESS)
+    parser.set_defaults(func=do_command)
+
+    ARGS = parser.parse_args()
+    ARGS.func(ARGS)
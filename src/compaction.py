@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compacts the labelled data before it is fed to crf_learn.
+"""
+
+import os
+import zlib
+import hashlib
+import threading
+
+def priority(blob, seed=0):
+    """
+    Deterministic sampling priority of a sentence, given its CONLL bytes.
+    """
+    return zlib.crc32(blob, seed)
+
+def to_bytes(sentence):
+    """
+    The CONLL bytes of @sentence, without the blank line after it.
+    """
+    return "".join("\t".join(fields) + "\n" for fields in sentence).encode("utf-8")
+
+def sample(strata, stratified, skip):
+    """
+    Picks @stratified indices from @strata, a list of lists of
+    (priority, index) sorted by priority, taking the highest priority
+    left in each stratum in turn and skipping indices for which @skip
+    is true.
+    """
+    iters = [reversed(stratum) for stratum in strata]
+    ret = []
+    while len(ret) < stratified and len(iters) > 0:
+        for it in list(iters):
+            if len(ret) == stratified:
+                break
+            for _, i in it:
+                if not skip(i):
+                    ret.append(i)
+                    break
+            else:
+                iters.remove(it)
+    return ret
+
+def compact(sentences, window=None, stratified=0, seed=0):
+    """
+    Removes duplicate labelled sentences, keeping the most recent copy.
+    If @window is set, only keeps the @window most recent sentences and
+    @stratified older ones, sampled evenly across the sets of tags they
+    contain. The sample only depends on @seed, so that compacting the
+    same data twice gives the same result.
+    """
+    latest, strata = {}, {}
+    for i, sentence in enumerate(sentences):
+        latest[tuple(map(tuple, sentence))] = i
+        strata.setdefault(frozenset(tok[-1] for tok in sentence), [])
+    keep = sorted(latest.values())
+    if window is None or len(keep) <= window + stratified:
+        return [sentences[i] for i in keep]
+
+    older = keep[:len(keep)-window]
+    for i in older:
+        strata[frozenset(tok[-1] for tok in sentences[i])].append((priority(to_bytes(sentences[i]), seed), i))
+    for stratum in strata.values():
+        stratum.sort()
+    sample_ = sample(list(strata.values()), stratified, lambda i: False)
+    return [sentences[i] for i in sorted(sample_ + keep[len(keep)-window:])]
+
+class Compactor(object):
+    """
+    Compacts a CONLL file that mostly grows by appending.
+
+    Remembers the hash and byte span of every sentence read so far, so
+    that compacting again only parses what was appended since; windowed
+    compaction then only touches the window and the sample. If the file
+    is replaced (by a rename) or shrinks, it is read again from the start.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset(None)
+
+    def reset(self, path):
+        self.path = path
+        self.ino = None
+        # How much of the file has been read, and the last sentence in it,
+        # to check that the file was only appended to.
+        self.offset = 0
+        self.tail = (0, b"")
+        # (begin, end) of every sentence read, in order.
+        self.spans = []
+        # Indices of sentences with a more recent copy.
+        self.superseded = set()
+        # Hash of a sentence -> index of its latest copy.
+        self.latest = {}
+        # Set of tags -> (priority, index) of sentences with those tags,
+        # in the order the sets were first seen; sorted by priority in keep().
+        self.strata = {}
+        # Strata appended to since they were last sorted.
+        self.unsorted = set()
+
+    def __add(self, begin, end, blob):
+        i = len(self.spans)
+        self.spans.append((begin, end))
+        key = hashlib.sha1(blob).digest()
+        if key in self.latest:
+            self.superseded.add(self.latest[key])
+        self.latest[key] = i
+        tags = frozenset(line.rpartition(b"\t")[2] for line in blob.split(b"\n") if len(line) > 0)
+        self.strata.setdefault(tags, []).append((priority(blob), i))
+        self.unsorted.add(tags)
+
+    def update(self, path):
+        """
+        Reads the sentences added to @path since the last update.
+        """
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            begin, tail = self.tail
+            if path != self.path or stat.st_ino != self.ino or stat.st_size < self.offset:
+                self.reset(path)
+            elif len(tail) > 0:
+                f.seek(begin)
+                if f.read(len(tail)) != tail:
+                    self.reset(path)
+            self.ino = stat.st_ino
+
+            f.seek(self.offset)
+            data = f.read(stat.st_size - self.offset)
+
+        pos, size = 0, len(data)
+        while pos < size:
+            # Skip blank lines between sentences.
+            if data[pos] == ord("\n"):
+                pos += 1
+                continue
+            end = data.find(b"\n\n", pos)
+            end = size if end < 0 else end+1
+            blob = data[pos:end]
+            self.__add(self.offset + pos, self.offset + end, blob if blob.endswith(b"\n") else blob + b"\n")
+            self.tail = (self.offset + pos, blob)
+            pos = end
+        self.offset += size
+
+    def keep(self, window=None, stratified=0):
+        """
+        Indices of the sentences compact() would keep.
+        """
+        if window is None or len(self.latest) <= window + stratified:
+            return [i for i in range(len(self.spans)) if i not in self.superseded]
+
+        recent = []
+        for i in range(len(self.spans)-1, -1, -1):
+            if i not in self.superseded:
+                recent.append(i)
+                if len(recent) == window:
+                    break
+        first = recent[-1]
+        # Each stratum is sorted apart from what was just appended, which
+        # sort() merges in linear time.
+        for tags in self.unsorted:
+            self.strata[tags].sort()
+        self.unsorted.clear()
+        sample_ = sample(list(self.strata.values()), stratified, lambda i: i >= first or i in self.superseded)
+        return sorted(sample_) + recent[::-1]
+
+    def compact(self, in_path, out_path, window=None, stratified=0):
+        """
+        Compacts the CONLL file at @in_path into @out_path.
+        @return: the number of sentences written.
+        """
+        with self.lock:
+            self.update(in_path)
+            keep = self.keep(window, stratified)
+            with open(in_path, "rb") as f, open(out_path, "wb") as out:
+                for i in keep:
+                    begin, end = self.spans[i]
+                    f.seek(begin)
+                    blob = f.read(end - begin)
+                    out.write(blob if blob.endswith(b"\n") else blob + b"\n")
+                    out.write(b"\n")
+            return len(keep)
+
+def test_compact():
+    a = [["a", "O"], ["b", "SPKR"]]
+    b = [["a", "O"], ["b", "O"]]
+    c = [["c", "CTNT"]]
+    d = [["d", "O"]]
+
+    assert compact([a, b, a, c]) == [b, a, c]
+    assert compact([a, b, c, d], window=1, stratified=2) == compact([a, b, c, d], window=1, stratified=2)
+    # Both older strata are represented before the window.
+    sentences = compact([a, a, b, c, d], window=1, stratified=2)
+    assert sentences[-1] == d
+    assert len(sentences) == 3
+    assert len(set(frozenset(tok[-1] for tok in sentence) for sentence in sentences[:2])) == 2
+
+def test_compactor():
+    """
+    Test that incremental compaction matches compact().
+    """
+    import random
+    import tempfile
+    from util import iter_conll, write_conll
+    rng = random.Random(0)
+    tags = ["O", "SPKR", "CTNT", "CUE"]
+    sentences = [[["w{}".format(rng.randint(0, 5)), rng.choice(tags)] for _ in range(rng.randint(1, 3))] for _ in range(200)]
+
+    wd = tempfile.mkdtemp()
+    in_path, out_path = os.path.join(wd, "train"), os.path.join(wd, "out")
+    compactor = Compactor()
+
+    def check(n, window, stratified):
+        compactor.compact(in_path, out_path, window, stratified)
+        with open(out_path) as f:
+            assert list(iter_conll(f)) == compact(sentences[:n], window, stratified)
+
+    with open(in_path, "w") as f:
+        for i, sentence in enumerate(sentences):
+            write_conll(f, sentence)
+            if i % 50 == 49:
+                f.flush()
+                check(i+1, 20, 10)
+                check(i+1, None, 0)
+    # Only the new sentences are read.
+    offset = compactor.offset
+    with open(in_path, "a") as f:
+        write_conll(f, sentences[0])
+    sentences.append(sentences[0])
+    check(len(sentences), 20, 10)
+    assert compactor.spans[-1][0] == offset
+
+    # Replacing the file reads it again.
+    sentences[:] = sentences[100:]
+    with open(in_path + ".tmp", "w") as f:
+        for sentence in sentences:
+            write_conll(f, sentence)
+    os.replace(in_path + ".tmp", in_path)
+    check(len(sentences), 20, 10)
+    check(len(sentences), 1000, 0)
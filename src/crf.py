@@ -5,10 +5,24 @@ CRF container
 """
 
 import os
+import time
+import shutil
+import tempfile
 import subprocess
-from subprocess import check_output, check_call
-from util import write_conll, read_conll_doc
+from subprocess import check_call, Popen, PIPE, CalledProcessError
+from util import write_conll, iter_conll
 from settings import CRF_LEARN, CRF_TEST
+from model_registry import ModelRegistry
+from compaction import Compactor
+
+# Options in [training] that are passed on to crf_learn.
+LEARN_OPTIONS = [
+    ("cost", "-c"),
+    ("freq", "-f"),
+    ("eta", "-e"),
+    ("maxiter", "-m"),
+    ("algorithm", "-a"),
+    ]
 
 class CRF(object):
     """
@@ -21,6 +35,24 @@ class CRF(object):
         self.test_path = os.path.join(wd, "test.input")
         self.model_path = config["paths"]["model"]
         self.template_path = config["paths"]["template"]
+        # Extra options passed to crf_learn; these change the model
+        # trained, unlike the number of threads.
+        self.learn_options = []
+        if "training" in config:
+            for key, flag in LEARN_OPTIONS:
+                if key in config["training"]:
+                    self.learn_options += [flag, config["training"][key]]
+        self.threads = config.getint("training", "threads", fallback=None)
+        self.registry = ModelRegistry(config)
+
+        # Interactive retrains only use the most recent @window sentences
+        # and @stratified older ones (see compaction.compact).
+        self.window = config.getint("training", "window", fallback=None)
+        self.stratified = config.getint("training", "stratified", fallback=0)
+        self.window_path = os.path.join(wd, "train.window.conll")
+        self.full_path = os.path.join(wd, "train.full.conll")
+        # Remembers what it has read so that retrains only parse new data.
+        self.compactor = Compactor()
 
     def infer(self, conll):
         """
@@ -33,19 +65,107 @@ class CRF(object):
                 write_conll(f, conll_)
                 f.write("\n")
 
-        output = check_output([CRF_TEST, "-m", self.model_path, self.test_path], universal_newlines=True)
-        conll_out = read_conll_doc(output)
-        assert len(conll_out) == len(conll)
-        tags = [[tok[-1] for tok in c] for c in conll_out]
+        # Read the output as it is produced instead of buffering all of it.
+        cmd = [CRF_TEST, "-m", self.model_path, self.test_path]
+        with Popen(cmd, stdout=PIPE, universal_newlines=True) as proc:
+            tags = [[tok[-1] for tok in c] for c in iter_conll(proc.stdout)]
+        if proc.returncode != 0:
+            raise CalledProcessError(proc.returncode, cmd)
+        assert len(tags) == len(conll)
         return tags
 
-    def retrain(self):
+    def compact(self, train_path=None, full=True):
+        """
+        Writes a deduplicated copy of the training data, that is also
+        windowed unless @full.
+        @train_path: compact this file instead of paths.train.
+        @return: the path of the compacted data.
+        """
+        if train_path is None:
+            train_path = self.train_path
+        if full or self.window is None:
+            self.compactor.compact(train_path, self.full_path)
+            return self.full_path
+        else:
+            self.compactor.compact(train_path, self.window_path, self.window, self.stratified)
+            return self.window_path
+
+    def retrain(self, train_path=None, full=True):
+        """
+        Retrain model on the compacted training data.
+        @train_path: train on this file instead of paths.train.
+        @full: if False, only train on a window of the data.
+        @return: True if crf_learn was actually run.
+        """
+        return self.train(self.compact(train_path, full))
+
+    def train(self, train_path):
         """
-        Retrain model
+        Train a model on @train_path, unless a model has already been
+        trained on exactly the same data, template and options.
+        @return: True if crf_learn was actually run.
         """
-        check_call([CRF_LEARN, self.template_path, self.train_path, self.model_path], stdout=subprocess.DEVNULL)
+        fingerprint = ModelRegistry.fingerprint(train_path, self.template_path, self.learn_options)
+        try:
+            self.registry.activate(fingerprint)
+            return False
+        except KeyError:
+            pass
+
+        model_path = self.registry.path(fingerprint)
+        os.makedirs(os.path.dirname(model_path), exist_ok=True)
+        start = time.time()
+        # Train into a temporary file so that a failed run never leaves
+        # behind a model that looks complete.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(model_path), suffix=".tmp")
+        os.close(fd)
+        options = list(self.learn_options)
+        if self.threads is not None:
+            options += ["-p", str(self.threads)]
+        try:
+            check_call([CRF_LEARN] + options + [self.template_path, train_path, tmp_path], stdout=subprocess.DEVNULL)
+        except Exception:
+            # Don't leave behind a directory without a model (or metadata),
+            # which the registry would never prune.
+            os.remove(tmp_path)
+            if not os.path.exists(model_path):
+                shutil.rmtree(os.path.dirname(model_path), ignore_errors=True)
+            raise
+        os.replace(tmp_path, model_path)
+        self.registry.add(fingerprint, train_path, time.time() - start)
+        self.registry.activate(fingerprint)
         return True
 
+def test_train_failure():
+    """
+    Test that a failed crf_learn leaves nothing behind in the registry.
+    """
+    global CRF_LEARN
+    from configparser import ConfigParser
+    wd = tempfile.mkdtemp()
+    config = ConfigParser()
+    config.read_dict({"paths": {
+        "work_dir": wd,
+        "train": os.path.join(wd, "train.conll"),
+        "model": os.path.join(wd, "model"),
+        "template": os.path.join(wd, "template"),
+        }})
+    for path in (config["paths"]["train"], config["paths"]["template"]):
+        with open(path, "w") as f:
+            f.write("a\tO\n\n")
+    model = CRF(config)
+
+    crf_learn, CRF_LEARN = CRF_LEARN, "false"
+    try:
+        model.retrain()
+        assert False
+    except CalledProcessError:
+        pass
+    finally:
+        CRF_LEARN = crf_learn
+        assert os.listdir(model.registry.root) == []
+        shutil.rmtree(wd)
+
 def test_infer():
     """
     Test if the inference method works.
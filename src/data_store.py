@@ -2,8 +2,9 @@
 Stores data, allowing for quick iteration.
 """
 
-import csv
-from util import annotate_sentence, parse_conll, write_conll
+import os
+
+from util import annotate_sentence, iter_conll, write_conll
 
 class DataStore(object):
     """
@@ -21,8 +22,7 @@ class DataStore(object):
 
         # Load all the labelled data.
         with open(train_path) as f:
-            reader = csv.reader(f, delimiter='\t')
-            self.labelled_data = list(parse_conll(reader))
+            self.labelled_data = list(iter_conll(f))
         # Load all the unlabelled data.
         self.unlabelled_data = list(open(source_path))
         # The assumption that the labelled data is a subset of the
@@ -34,25 +34,30 @@ class DataStore(object):
         # Open a appendable handle to the labelled data file
         self.labelled_data_file = open(train_path, 'a')
 
-    def update(self, conll, tags):
+    def update(self, conll, tags, index=None):
         """
-        Updates labels for the current example.
+        Updates labels for the example at @index (by default, the current example).
         """
+        if index is None:
+            index = self.cur_index-1
         # Create labelled data
         conll_labelled = [feats[:self.TAG_LABEL] + [t] for feats, t in zip(conll, tags)]
 
         # If we've move previous, rewrite the whole labelled set.
-        if self.cur_index <= len(self.labelled_data):
-            self.labelled_data[self.cur_index-1] = conll_labelled
-            self.labelled_data_file.close()
-            self.labelled_data_file = open(self.train_path,'w')
-            for conll in self.labelled_data:
-                write_conll(self.labelled_data_file, conll)
+        # Write a new file and rename it, so that readers (see
+        # compaction.Compactor) can tell it was rewritten.
+        if index < len(self.labelled_data):
+            self.labelled_data[index] = conll_labelled
             self.labelled_data_file.close()
+            with open(self.train_path + ".tmp", 'w') as f:
+                for conll in self.labelled_data:
+                    write_conll(f, conll)
+            os.replace(self.train_path + ".tmp", self.train_path)
             self.labelled_data_file = open(self.train_path,'a')
         else:
             self.labelled_data.append(conll_labelled)
             write_conll(self.labelled_data_file, conll_labelled)
+            self.labelled_data_file.flush()
 
     def __iter__(self):
         """
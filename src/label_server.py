@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Lets several annotators label the same data at once.
+
+The server owns the DataStore and retrains the CRF; each client runs an
+EditShell, leases sentences from the server and sends back their labels.
+New models are sent to clients along with their next reply.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import threading
+from itertools import chain
+from contextlib import contextmanager
+from multiprocessing.connection import Listener, Client
+
+from crf import CRF
+from data_store import DataStore
+from scheduler import RetrainScheduler
+from util import write_conll
+
+def get_address(config):
+    """
+    Returns the address and authkey of the server from [server].
+    The authkey has no default: requests are unpickled, so anyone who
+    knows it can run code on the server.
+    """
+    host, port = config.get("server", "address", fallback="localhost:6000").split(":")
+    authkey = config.get("server", "authkey", fallback="")
+    if len(authkey) == 0:
+        raise ValueError("Set [server] authkey to a secret shared with the annotators")
+    return (host, int(port)), authkey.encode("utf-8")
+
+class LeaseException(Exception):
+    pass
+
+class LabelServer(object):
+    """
+    Hands out disjoint sentence leases to clients and applies their updates.
+    """
+
+    def __init__(self, config):
+        self.data = DataStore(config)
+        self.model = CRF(config)
+        self.scheduler = RetrainScheduler(config)
+        self.snapshot_path = os.path.join(config["paths"]["work_dir"], "train.snapshot.conll")
+        self.pending_path = os.path.join(config["paths"]["work_dir"], "train.pending.json")
+        self.address, self.authkey = get_address(config)
+
+        # Protects everything below as well as self.data.
+        self.lock = threading.Lock()
+        # index -> id of the client holding the lease.
+        self.leases = {}
+        # index -> (conll, tags) saved ahead of some unlabelled
+        # sentence; these are written in order once it is saved.
+        # These are also kept in self.pending_path so that they survive a restart.
+        self.pending = {}
+        self.__load_pending()
+        # index -> labels of every sentence in the snapshot, or None
+        # until it is first written.
+        self.snapshot = None
+        # Indices saved since the snapshot was last written.
+        self.changed = set()
+        self.clients = set()
+        self.retraining = False
+        self.retrain_thread = None
+        # Set once the server is shutting down; no retrains start after that.
+        self.closed = False
+
+        self.model_version, self.model_blob, self.model_ino = 0, None, None
+        if os.path.exists(self.model.model_path):
+            self.__load_model()
+
+    def __load_model(self):
+        with open(self.model.model_path, "rb") as f:
+            # Models are renamed into place, so a new one has a new inode.
+            self.model_ino = os.fstat(f.fileno()).st_ino
+            self.model_blob = f.read()
+        self.model_version += 1
+
+    def __check_model(self):
+        """
+        Load the model if it changed, e.g. after 'qlabel models --rollback'.
+        """
+        try:
+            ino = os.stat(self.model.model_path).st_ino
+        except FileNotFoundError:
+            return
+        if ino != self.model_ino:
+            self.__load_model()
+
+    def __load_pending(self):
+        if not os.path.exists(self.pending_path):
+            return
+        with open(self.pending_path) as f:
+            for index, (conll, tags) in json.load(f).items():
+                self.pending[int(index)] = (conll, tags)
+        # The train file may have been labelled past these in the meantime.
+        for index in [index for index in self.pending if index < self.frontier()]:
+            del self.pending[index]
+        self.__flush_pending()
+
+    def __save_pending(self):
+        """
+        Write self.pending to disk, replacing the old copy atomically.
+        """
+        with open(self.pending_path + ".tmp", "w") as f:
+            json.dump({str(index): value for index, value in self.pending.items()}, f)
+        os.replace(self.pending_path + ".tmp", self.pending_path)
+
+    def __flush_pending(self):
+        """
+        Write out every pending sentence that is now at the frontier.
+        """
+        while self.frontier() in self.pending:
+            index = self.frontier()
+            self.data.update(*self.pending.pop(index), index=index)
+        self.__save_pending()
+
+    def __reload_model(self):
+        with self.lock:
+            self.__check_model()
+
+    def frontier(self):
+        """
+        Index of the first unlabelled sentence.
+        """
+        return len(self.data.labelled_data)
+
+    def metadata(self):
+        return "v{} {}/{} n={}".format(self.model_version, self.frontier() + len(self.pending), len(self.data), len(self.clients))
+
+    def reserve(self, client_id, index=None, exclude=()):
+        """
+        Lease the sentence at @index to the client, or the first free
+        unlabelled one that isn't in @exclude if @index is None.
+        @return: the index leased, or None if every sentence is labelled or leased.
+        """
+        if index is None:
+            for index_ in range(self.frontier(), len(self.data)):
+                if index_ not in self.leases and index_ not in self.pending and index_ not in exclude:
+                    index = index_
+                    break
+            else:
+                return None
+        elif index < 0 or index >= len(self.data):
+            raise LeaseException("No sentence at index {}".format(index))
+        elif self.leases.get(index, client_id) != client_id:
+            raise LeaseException("Sentence {} is being labelled by someone else".format(index))
+        self.leases[index] = client_id
+        return index
+
+    def release(self, client_id, index):
+        """
+        Release a lease held by the client.
+        """
+        if self.leases.get(index) == client_id:
+            del self.leases[index]
+
+    def lease(self, client_id, index=None, exclude=()):
+        """
+        Lease a sentence to the client.
+        @return: the index and conll of the sentence, or None if there is nothing left to label.
+        """
+        with self.lock:
+            index = self.reserve(client_id, index, exclude)
+            if index is None:
+                return None
+            if index < self.frontier():
+                return index, self.data.labelled_data[index]
+            elif index in self.pending:
+                conll, tags = self.pending[index]
+                return index, [feats[:DataStore.TAG_LABEL] + [t] for feats, t in zip(conll, tags)]
+        # Annotating the sentence calls out to CoreNLP, so don't hold the lock.
+        try:
+            return index, self.data[index]
+        except Exception:
+            with self.lock:
+                self.release(client_id, index)
+            raise
+
+    def save(self, client_id, index, conll, guess, tags):
+        """
+        Save the labels of a leased sentence, and retrain if needed.
+        """
+        with self.lock:
+            if self.leases.get(index) != client_id:
+                raise LeaseException("Sentence {} isn't leased to this client".format(index))
+            del self.leases[index]
+
+            if index <= self.frontier():
+                self.data.update(conll, tags, index)
+                # Write out everything that was waiting on this sentence.
+                self.__flush_pending()
+            else:
+                self.pending[index] = (conll, tags)
+                self.__save_pending()
+
+            self.changed.add(index)
+            self.scheduler.update(guess, tags)
+            if self.retraining or self.closed or not self.scheduler.should_retrain():
+                return
+            # Train on a snapshot so that saves can continue in the meantime;
+            # saves from now on count towards the next retrain.
+            self.scheduler.start()
+            self.__write_snapshot()
+            self.retraining = True
+            self.retrain_thread = threading.Thread(target=self.retrain, daemon=True)
+            self.retrain_thread.start()
+
+    def __labelled(self, index):
+        """
+        The labelled sentence at @index, which may be pending.
+        """
+        if index < self.frontier():
+            return self.data.labelled_data[index]
+        conll, tags = self.pending[index]
+        return [feats[:DataStore.TAG_LABEL] + [t] for feats, t in zip(conll, tags)]
+
+    def __write_snapshot(self):
+        """
+        Write the labelled data, including pending sentences, to the
+        snapshot. New sentences are appended so that the CRF only has
+        to compact those (see compaction.Compactor); the snapshot is
+        only rewritten if a sentence in it was relabelled.
+        """
+        changed = [(index, self.__labelled(index)) for index in sorted(self.changed)]
+        self.changed.clear()
+        if self.snapshot is not None and all(self.snapshot.get(index, conll) == conll for index, conll in changed):
+            with open(self.snapshot_path, "a") as f:
+                for index, conll in changed:
+                    if index not in self.snapshot:
+                        write_conll(f, conll)
+                        self.snapshot[index] = conll
+            return
+
+        self.snapshot = {index: self.__labelled(index) for index in chain(range(self.frontier()), self.pending)}
+        # Rename it into place so that it is read again from the start.
+        with open(self.snapshot_path + ".tmp", "w") as f:
+            for conll in self.snapshot.values():
+                write_conll(f, conll)
+        os.replace(self.snapshot_path + ".tmp", self.snapshot_path)
+
+    def retrain(self):
+        """
+        Retrain on the snapshot and share the new model with clients.
+        """
+        try:
+            self.scheduler.retrain(self.model, callback=self.__reload_model, train_path=self.snapshot_path)
+            self.__reload_model()
+        finally:
+            with self.lock:
+                self.retraining = False
+
+    def finish(self):
+        """
+        Wait for any retrain, and make sure that the final model has
+        been trained on all the labelled data.
+        """
+        with self.lock:
+            self.closed = True
+            thread = self.retrain_thread
+        if thread is not None:
+            thread.join()
+        with self.lock:
+            self.__write_snapshot()
+        self.scheduler.finish(self.model, train_path=self.snapshot_path)
+
+    def handle(self, conn, client_id):
+        """
+        Serve requests from a single client until it disconnects.
+        """
+        with self.lock:
+            self.clients.add(client_id)
+        try:
+            while True:
+                try:
+                    request = conn.recv()
+                except EOFError:
+                    break
+
+                reply = {}
+                try:
+                    if request["type"] == "lease":
+                        reply["sentence"] = self.lease(client_id, request.get("index"), request.get("exclude", ()))
+                    elif request["type"] == "save":
+                        self.save(client_id, request["index"], request["conll"], request["guess"], request["tags"])
+                    elif request["type"] == "release":
+                        with self.lock:
+                            self.release(client_id, request["index"])
+                except LeaseException as e:
+                    reply["error"] = str(e)
+                except Exception as e:
+                    # Report the error to the client instead of dropping it.
+                    reply["error"] = "{}: {}".format(type(e).__name__, e)
+
+                with self.lock:
+                    self.__check_model()
+                    reply["metadata"] = self.metadata()
+                    if request.get("model_version", 0) < self.model_version:
+                        reply["model"] = (self.model_version, self.model_blob)
+                conn.send(reply)
+        finally:
+            # Give up any sentences the client was still working on.
+            with self.lock:
+                for index in [index for index, client_id_ in self.leases.items() if client_id_ == client_id]:
+                    del self.leases[index]
+                self.clients.discard(client_id)
+            conn.close()
+
+    def serve_forever(self):
+        """
+        Serve clients until interrupted, then train the final model.
+        """
+        try:
+            with Listener(self.address, authkey=self.authkey) as listener:
+                client_id = 0
+                while True:
+                    conn = listener.accept()
+                    client_id += 1
+                    threading.Thread(target=self.handle, args=(conn, client_id), daemon=True).start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.finish()
+
+class LabelClient(object):
+    """
+    Talks to a LabelServer and keeps a local copy of its latest model.
+    """
+
+    def __init__(self, config):
+        address, authkey = get_address(config)
+        self.conn = Client(address, authkey=authkey)
+
+        # Keep the model and crf_test input private to this client.
+        self.tmp_dir = tempfile.mkdtemp(prefix="qlabel-")
+        self.model = CRF(config)
+        self.model.model_path = os.path.join(self.tmp_dir, "model")
+        self.model.test_path = os.path.join(self.tmp_dir, "test.input")
+        self.model_version = 0
+        self.metadata = ""
+
+    def request(self, type_, **kwargs):
+        kwargs["type"] = type_
+        kwargs["model_version"] = self.model_version
+        self.conn.send(kwargs)
+        reply = self.conn.recv()
+
+        self.metadata = reply["metadata"]
+        if "model" in reply:
+            self.model_version, blob = reply["model"]
+            with open(self.model.model_path + ".tmp", "wb") as f:
+                f.write(blob)
+            os.replace(self.model.model_path + ".tmp", self.model.model_path)
+        if "error" in reply:
+            raise LeaseException(reply["error"])
+        return reply
+
+    def lease(self, index=None, exclude=()):
+        return self.request("lease", index=index, exclude=list(exclude))["sentence"]
+
+    def save(self, index, conll, guess, tags):
+        self.request("save", index=index, conll=conll, guess=guess, tags=tags)
+
+    def release(self, index):
+        self.request("release", index=index)
+
+    def infer(self, conll):
+        """
+        Tag the sentence with the latest model, if there is one.
+        """
+        if self.model_version == 0:
+            return None
+        return self.model.infer([conll])[0]
+
+    def close(self):
+        self.conn.close()
+        shutil.rmtree(self.tmp_dir)
+
+@contextmanager
+def server_config(txt, train=""):
+    """
+    A config for a server in a temporary work directory, with @txt as
+    the input and @train as the labelled data; removed afterwards.
+    """
+    from configparser import ConfigParser
+    with tempfile.TemporaryDirectory() as wd:
+        config = ConfigParser()
+        config.read_dict({"paths": {
+            "work_dir": wd,
+            "train": os.path.join(wd, "train.conll"),
+            "txt": os.path.join(wd, "input.txt"),
+            "model": os.path.join(wd, "model"),
+            "template": os.path.join(wd, "template"),
+            }, "training": {"retrain_every": "1000"}, "server": {"authkey": "test"}})
+        with open(config["paths"]["train"], "w") as f:
+            f.write(train)
+        with open(config["paths"]["txt"], "w") as f:
+            f.write(txt)
+        yield config
+
+def test_label_server():
+    """
+    Test that leases are disjoint and that out of order saves are
+    written in order.
+    """
+    with server_config("a\nb\nc\n", "a\ta\tDT\tO\n\n") as config:
+        server = LabelServer(config)
+
+        assert server.reserve(1) == 1
+        assert server.reserve(2) == 2
+        assert server.reserve(3) is None
+        try:
+            server.reserve(2, 1)
+            assert False
+        except LeaseException:
+            pass
+
+        # Saving sentence 2 waits for sentence 1.
+        server.save(2, 2, [["c", "c", "NN"]], ["O"], ["SPKR"])
+        assert server.frontier() == 1
+        server.save(1, 1, [["b", "b", "NN"]], ["O"], ["CTNT"])
+        assert server.frontier() == 3
+        assert [conll[0][-1] for conll in server.data.labelled_data] == ["O", "CTNT", "SPKR"]
+        with open(config["paths"]["train"]) as f:
+            assert f.read() == "a\ta\tDT\tO\n\nb\tb\tNN\tCTNT\n\nc\tc\tNN\tSPKR\n\n"
+
+def test_label_server_skip():
+    """
+    Test that saves past a skipped sentence survive a restart.
+    """
+    with server_config("a\nb\nc\n") as config:
+        server = LabelServer(config)
+
+        # The client skips sentence 0 and labels the rest.
+        assert server.reserve(1, exclude={0}) == 1
+        server.save(1, 1, [["b", "b", "NN"]], ["O"], ["CTNT"])
+        assert server.reserve(1, exclude={0}) == 2
+        server.save(1, 2, [["c", "c", "NN"]], ["O"], ["SPKR"])
+        assert server.reserve(1, exclude={0}) is None
+        assert server.frontier() == 0
+
+        server = LabelServer(config)
+        assert sorted(server.pending) == [1, 2]
+        assert server.reserve(2) == 0
+        server.save(2, 0, [["a", "a", "DT"]], ["O"], ["O"])
+        assert server.frontier() == 3
+        assert server.pending == {}
+        with open(config["paths"]["train"]) as f:
+            assert f.read() == "a\ta\tDT\tO\n\nb\tb\tNN\tCTNT\n\nc\tc\tNN\tSPKR\n\n"
+
+def test_label_server_error():
+    """
+    Test that errors are sent back to the client without closing the connection.
+    """
+    from multiprocessing import Pipe
+    with server_config("a\n") as config:
+        server = LabelServer(config)
+
+        conn, conn_ = Pipe()
+        thread = threading.Thread(target=server.handle, args=(conn_, 1), daemon=True)
+        thread.start()
+        # A malformed request.
+        conn.send({"type": "save"})
+        assert conn.recv()["error"] == "KeyError: 'index'"
+        conn.send({"type": "release", "index": 0})
+        assert "error" not in conn.recv()
+        # A model activated outside the server (e.g. by a rollback) is sent on.
+        with open(config["paths"]["model"] + ".tmp", "wb") as f:
+            f.write(b"model")
+        os.replace(config["paths"]["model"] + ".tmp", config["paths"]["model"])
+        conn.send({"type": "release", "index": 0})
+        assert conn.recv()["model"] == (1, b"model")
+        conn.close()
+        thread.join()
+
+def test_get_address():
+    """
+    Test that the server refuses to run without an authkey.
+    """
+    from configparser import ConfigParser
+    config = ConfigParser()
+    config.read_dict({"server": {"address": "0.0.0.0:6000"}})
+    try:
+        get_address(config)
+        assert False
+    except ValueError:
+        pass
+    config["server"]["authkey"] = "secret"
+    assert get_address(config) == (("0.0.0.0", 6000), b"secret")
+
+def test_label_server_snapshot():
+    """
+    Test that new sentences are appended to the snapshot, and that it is
+    rewritten when a sentence in it is relabelled.
+    """
+    with server_config("a\nb\nc\n", "a\ta\tDT\tO\n\n") as config:
+        server = LabelServer(config)
+        write_snapshot = server._LabelServer__write_snapshot
+
+        write_snapshot()
+        ino = os.stat(server.snapshot_path).st_ino
+        server.reserve(1, 2)
+        server.save(1, 2, [["c", "c", "NN"]], ["O"], ["SPKR"])
+        write_snapshot()
+        assert os.stat(server.snapshot_path).st_ino == ino
+        with open(server.snapshot_path) as f:
+            assert f.read() == "a\ta\tDT\tO\n\nc\tc\tNN\tSPKR\n\n"
+
+        server.reserve(1, 0)
+        server.save(1, 0, [["a", "a", "DT"]], ["O"], ["CUE"])
+        write_snapshot()
+        with open(server.snapshot_path) as f:
+            assert f.read() == "a\ta\tDT\tCUE\n\nc\tc\tNN\tSPKR\n\n"
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Keeps versioned CRF models in the work directory, keyed by a
+fingerprint of the inputs they were trained on.
+"""
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+
+class ModelRegistry(object):
+    """
+    Stores the last few trained models in @work_dir/models/<fingerprint>/,
+    each along with some metadata about how it was trained.
+
+    Models may be trained in the background, so all methods are
+    guarded by a lock.
+    """
+    MODEL_FILE = "model"
+    META_FILE = "meta.json"
+    # Which model is in paths.model, and whether it was pinned there by
+    # a rollback.
+    ACTIVE_FILE = "active.json"
+
+    def __init__(self, config):
+        wd = config["paths"]["work_dir"]
+        self.root = os.path.join(wd, "models")
+        self.model_path = config["paths"]["model"]
+        self.keep = config.getint("training", "keep_models", fallback=5)
+        os.makedirs(self.root, exist_ok=True)
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def fingerprint(train_path, template_path, options):
+        """
+        Hash the training data, template and crf_learn options.
+        """
+        digest = hashlib.sha1()
+        for path in (train_path, template_path):
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 16), b""):
+                    digest.update(chunk)
+            digest.update(b"\0")
+        digest.update(" ".join(options).encode("utf-8"))
+        return digest.hexdigest()
+
+    def path(self, fingerprint):
+        """
+        Path of the model stored under @fingerprint.
+        """
+        return os.path.join(self.root, fingerprint, self.MODEL_FILE)
+
+    def lookup(self, fingerprint):
+        """
+        Returns the path of the model for @fingerprint if it exists, else None.
+        """
+        with self.lock:
+            path = self.path(fingerprint)
+            if not os.path.exists(path):
+                return None
+            self.__touch(fingerprint)
+            return path
+
+    @staticmethod
+    def __write_meta(meta_path, meta):
+        """
+        Write and rename so that readers never see a partial file.
+        """
+        with open(meta_path + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(meta_path + ".tmp", meta_path)
+
+    def __touch(self, fingerprint):
+        """
+        Mark the model as recently used so that it isn't pruned.
+        """
+        meta_path = os.path.join(self.root, fingerprint, self.META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                meta = json.load(f)
+            meta["last_used"] = time.time()
+            self.__write_meta(meta_path, meta)
+
+    def add(self, fingerprint, train_path, train_time):
+        """
+        Records metadata for a model just written to self.path(@fingerprint)
+        and prunes old versions.
+        """
+        with open(train_path) as f:
+            n_sentences = sum(1 for line in f if len(line.strip()) == 0)
+        now = time.time()
+        meta = {
+            "fingerprint": fingerprint,
+            "created": now,
+            "last_used": now,
+            "train_time": train_time,
+            "sentences": n_sentences,
+            "size": os.path.getsize(self.path(fingerprint)),
+            }
+        with self.lock:
+            self.__write_meta(os.path.join(self.root, fingerprint, self.META_FILE), meta)
+            self.prune()
+        return meta
+
+    def versions(self):
+        """
+        Returns the metadata of all stored models, most recently trained first.
+        """
+        ret = []
+        with self.lock:
+            for fingerprint in os.listdir(self.root):
+                meta_path = os.path.join(self.root, fingerprint, self.META_FILE)
+                if not os.path.exists(meta_path):
+                    continue
+                with open(meta_path) as f:
+                    ret.append(json.load(f))
+        return sorted(ret, key=lambda meta: meta["created"], reverse=True)
+
+    def prune(self):
+        """
+        Only keep the @keep most recently used models, and the active one.
+        """
+        with self.lock:
+            active = self.active()["fingerprint"]
+            versions = sorted(self.versions(), key=lambda meta: meta["last_used"], reverse=True)
+            for meta in versions[self.keep:]:
+                if meta["fingerprint"] != active:
+                    shutil.rmtree(os.path.join(self.root, meta["fingerprint"]))
+
+    def active(self):
+        """
+        Returns the fingerprint of the model in paths.model (or None) and
+        whether it is pinned.
+        """
+        path = os.path.join(self.root, self.ACTIVE_FILE)
+        with self.lock:
+            if not os.path.exists(path):
+                return {"fingerprint": None, "pinned": False}
+            with open(path) as f:
+                return json.load(f)
+
+    def activate(self, fingerprint, pin=None):
+        """
+        Copy the model for @fingerprint to paths.model, unless another
+        model has been pinned there.
+        @pin: if set, pin (or unpin) the model even if another one is pinned.
+        @return: True if the model was activated.
+        """
+        with self.lock:
+            path = self.lookup(fingerprint)
+            if path is None:
+                raise KeyError(fingerprint)
+            if pin is None and self.active()["pinned"]:
+                return False
+            # Copy and rename so that readers never see a partial model.
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.model_path)), suffix=".tmp")
+            os.close(fd)
+            shutil.copyfile(path, tmp_path)
+            os.replace(tmp_path, self.model_path)
+            self.__write_meta(os.path.join(self.root, self.ACTIVE_FILE), {"fingerprint": fingerprint, "pinned": bool(pin)})
+            return True
+
+    def rollback(self, steps=1):
+        """
+        Activate and pin the model trained @steps versions before the
+        active one, so that later retrains don't replace it.
+        """
+        with self.lock:
+            versions = self.versions()
+            fingerprints = [meta["fingerprint"] for meta in versions]
+            active = self.active()["fingerprint"]
+            index = fingerprints.index(active) if active in fingerprints else 0
+            if index + steps >= len(versions):
+                raise IndexError("Only {} model versions are stored before the active one".format(len(versions) - index - 1))
+            meta = versions[index + steps]
+            self.activate(meta["fingerprint"], pin=True)
+        return meta
+
+    def unpin(self):
+        """
+        Activate the newest model, and let retrains replace it again.
+        """
+        with self.lock:
+            versions = self.versions()
+            if len(versions) == 0:
+                raise IndexError("No model versions are stored")
+            self.activate(versions[0]["fingerprint"], pin=False)
+        return versions[0]
+
+def test_model_registry():
+    """
+    Test that models are found by fingerprint and can be rolled back.
+    """
+    from configparser import ConfigParser
+    wd = tempfile.mkdtemp()
+    config = ConfigParser()
+    config.read_dict({"paths": {"work_dir": wd, "model": os.path.join(wd, "model")},
+                      "training": {"keep_models": "2"}})
+    registry = ModelRegistry(config)
+
+    template_path, train_path = os.path.join(wd, "template"), os.path.join(wd, "train")
+    with open(template_path, "w") as f:
+        f.write("U00:%x[0,0]\n")
+
+    fingerprints = []
+    for i in range(3):
+        with open(train_path, "w") as f:
+            f.write("word{}\tO\n\n".format(i))
+        fingerprint = ModelRegistry.fingerprint(train_path, template_path, [])
+        assert registry.lookup(fingerprint) is None
+        os.makedirs(os.path.dirname(registry.path(fingerprint)))
+        with open(registry.path(fingerprint), "w") as f:
+            f.write(str(i))
+        registry.add(fingerprint, train_path, 0.)
+        registry.activate(fingerprint)
+        assert registry.lookup(fingerprint) is not None
+        fingerprints.append(fingerprint)
+
+    # Only the last two versions are kept.
+    assert registry.lookup(fingerprints[0]) is None
+    assert [meta["fingerprint"] for meta in registry.versions()] == fingerprints[:0:-1]
+    assert registry.active() == {"fingerprint": fingerprints[2], "pinned": False}
+    registry.rollback(1)
+    with open(config["paths"]["model"]) as f:
+        assert f.read() == "1"
+    assert registry.active() == {"fingerprint": fingerprints[1], "pinned": True}
+    # Rolling back is relative to the active model.
+    try:
+        registry.rollback(1)
+        assert False
+    except IndexError:
+        pass
+
+    # New models don't replace a pinned one until it is unpinned.
+    with open(train_path, "w") as f:
+        f.write("word3\tO\n\n")
+    fingerprint = ModelRegistry.fingerprint(train_path, template_path, [])
+    os.makedirs(os.path.dirname(registry.path(fingerprint)))
+    with open(registry.path(fingerprint), "w") as f:
+        f.write("3")
+    registry.add(fingerprint, train_path, 0.)
+    assert not registry.activate(fingerprint)
+    assert registry.lookup(fingerprints[1]) is not None
+    with open(config["paths"]["model"]) as f:
+        assert f.read() == "1"
+    registry.unpin()
+    with open(config["paths"]["model"]) as f:
+        assert f.read() == "3"
@@ -2,6 +2,9 @@
 Various utilities for interfacing with postgres
 """
 
+import re
+import struct
+
 def unescape_sql(inp):
     if inp.startswith('"') and inp.endswith('"'):
         inp = inp[1:-1]
@@ -59,3 +62,292 @@ def test_to_psql_array():
     lst = ["Bond", "was", "set", "at", "$", "1,500", "each","."]
     inp_ = to_psql_array(lst)
     assert inp == inp_
+
+# COPY formats (see https://www.postgresql.org/docs/current/sql-copy.html).
+# Column types are given as 'text', 'int4', 'int8', and arrays of those,
+# e.g. 'int4[]'.
+
+COPY_NULL = "\\N"
+COPY_ESCAPES = str.maketrans({"\\": "\\\\", "\n": "\\n", "\r": "\\r", "\t": "\\t"})
+COPY_UNESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+COPY_UNESCAPE_RE = re.compile(r"\\(x[0-9a-fA-F]{1,2}|[0-7]{1,3}|.)")
+
+COPY_SIGNATURE = b"PGCOPY\n\xff\r\n\x00"
+TYPE_OIDS = {"int4": 23, "int8": 20, "text": 25}
+INT_FORMATS = {"int4": struct.Struct("!i"), "int8": struct.Struct("!q")}
+# Field count, length and array headers.
+INT16 = struct.Struct("!h")
+INT32 = struct.Struct("!i")
+ARRAY_HEADER = struct.Struct("!iiiii")
+
+# Size at which the writers flush their buffers.
+COPY_BUFFER_SIZE = 1 << 20
+
+def escape_copy(inp):
+    """
+    Escapes a string for the COPY text format.
+    """
+    return inp.translate(COPY_ESCAPES)
+
+def unescape_copy(inp):
+    """
+    Unescapes a field in the COPY text format.
+    """
+    def unescape(match):
+        seq = match.group(1)
+        if seq[0] == "x" and len(seq) > 1:
+            return chr(int(seq[1:], 16))
+        elif seq[0] in "01234567":
+            return chr(int(seq, 8))
+        else:
+            return COPY_UNESCAPES.get(seq, seq)
+    return COPY_UNESCAPE_RE.sub(unescape, inp)
+
+def format_array(arr):
+    """
+    Formats a postgres array literal, quoting every element.
+    """
+    def quote(elem):
+        if elem is None:
+            return "NULL"
+        return '"' + str(elem).replace('\\', '\\\\').replace('"', '\\"') + '"'
+    return '{' + ','.join(quote(elem) for elem in arr) + '}'
+
+def parse_array(inp):
+    """
+    Parses a (one-dimensional) postgres array literal; unquoted NULLs
+    are returned as None.
+    """
+    assert inp.startswith("{") and inp.endswith("}"), "Not an array: " + inp
+    inp = inp[1:-1]
+    lst = []
+    elem, quoted, in_quotes, escaped = [], False, False, False
+    for ch in inp:
+        if escaped:
+            elem.append(ch)
+            escaped = False
+        elif ch == '\\':
+            escaped = True
+        elif ch == '"':
+            in_quotes, quoted = not in_quotes, True
+        elif ch == ',' and not in_quotes:
+            elem = "".join(elem)
+            lst.append(None if not quoted and elem == "NULL" else elem)
+            elem, quoted = [], False
+        else:
+            elem.append(ch)
+    if len(inp) > 0:
+        elem = "".join(elem)
+        lst.append(None if not quoted and elem == "NULL" else elem)
+    return lst
+
+def _element_type(type_):
+    return type_[:-2] if type_.endswith("[]") else None
+
+def _from_text(value, type_):
+    return int(value) if type_ in INT_FORMATS else value
+
+def format_copy_text(value, type_):
+    """
+    Formats a single value as a field in the COPY text format.
+    """
+    if value is None:
+        return COPY_NULL
+    elif _element_type(type_) is not None:
+        return escape_copy(format_array(value))
+    else:
+        return escape_copy(str(value))
+
+def parse_copy_text(field, type_):
+    """
+    Parses a single field in the COPY text format.
+    """
+    if field == COPY_NULL:
+        return None
+    value = unescape_copy(field)
+    elem_type = _element_type(type_)
+    if elem_type is not None:
+        return [elem if elem is None else _from_text(elem, elem_type) for elem in parse_array(value)]
+    return _from_text(value, type_)
+
+def encode_copy_binary(value, type_):
+    """
+    Encodes a single value (without its length) in the COPY binary format.
+    """
+    elem_type = _element_type(type_)
+    if elem_type is not None:
+        elems = [None if elem is None else encode_copy_binary(elem, elem_type) for elem in value]
+        has_null = int(any(elem is None for elem in elems))
+        if len(elems) == 0:
+            ret = [INT32.pack(0), INT32.pack(0), INT32.pack(TYPE_OIDS[elem_type])]
+        else:
+            ret = [ARRAY_HEADER.pack(1, has_null, TYPE_OIDS[elem_type], len(elems), 1)]
+        for elem in elems:
+            if elem is None:
+                ret.append(INT32.pack(-1))
+            else:
+                ret.append(INT32.pack(len(elem)))
+                ret.append(elem)
+        return b"".join(ret)
+    elif type_ in INT_FORMATS:
+        return INT_FORMATS[type_].pack(value)
+    else:
+        return str(value).encode("utf-8")
+
+def decode_copy_binary(data, type_):
+    """
+    Decodes a single value in the COPY binary format.
+    """
+    elem_type = _element_type(type_)
+    if elem_type is not None:
+        ndim, _, oid = struct.unpack_from("!iii", data)
+        assert oid == TYPE_OIDS[elem_type], "Unexpected array element type {}".format(oid)
+        if ndim == 0:
+            return []
+        assert ndim == 1, "Only one-dimensional arrays are supported"
+        size, _ = struct.unpack_from("!ii", data, 12)
+        offset, ret = 20, []
+        for _ in range(size):
+            length, = INT32.unpack_from(data, offset)
+            offset += INT32.size
+            if length < 0:
+                ret.append(None)
+            else:
+                ret.append(decode_copy_binary(data[offset:offset+length], elem_type))
+                offset += length
+        return ret
+    elif type_ in INT_FORMATS:
+        return INT_FORMATS[type_].unpack(data)[0]
+    else:
+        return bytes(data).decode("utf-8")
+
+class CopyTextWriter(object):
+    """
+    Writes rows in the COPY text format to a text stream.
+    """
+    def __init__(self, ostream, types, buffer_size=COPY_BUFFER_SIZE):
+        self.ostream = ostream
+        self.types = types
+        self.buffer_size = buffer_size
+        self.buf, self.buf_len = [], 0
+
+    def writerow(self, row):
+        assert len(row) == len(self.types)
+        line = "\t".join(format_copy_text(value, type_) for value, type_ in zip(row, self.types)) + "\n"
+        self.buf.append(line)
+        self.buf_len += len(line)
+        if self.buf_len >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.ostream.write("".join(self.buf))
+        self.buf, self.buf_len = [], 0
+
+    def close(self):
+        self.flush()
+        self.ostream.flush()
+
+class CopyBinaryWriter(object):
+    """
+    Writes rows in the COPY binary format to a binary stream.
+    """
+    def __init__(self, ostream, types, buffer_size=COPY_BUFFER_SIZE):
+        self.ostream = ostream
+        self.types = types
+        self.buffer_size = buffer_size
+        # Signature, flags and header extension length.
+        self.buf = bytearray(COPY_SIGNATURE + INT32.pack(0) + INT32.pack(0))
+
+    def writerow(self, row):
+        assert len(row) == len(self.types)
+        buf = self.buf
+        buf += INT16.pack(len(row))
+        for value, type_ in zip(row, self.types):
+            if value is None:
+                buf += INT32.pack(-1)
+            else:
+                data = encode_copy_binary(value, type_)
+                buf += INT32.pack(len(data))
+                buf += data
+        if len(buf) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        self.ostream.write(self.buf)
+        self.buf = bytearray()
+
+    def close(self):
+        """
+        Writes the file trailer.
+        """
+        self.buf += INT16.pack(-1)
+        self.flush()
+        self.ostream.flush()
+
+def read_copy_text(istream, types):
+    """
+    Reads rows in the COPY text format from a text stream.
+    """
+    for line in istream:
+        line = line.rstrip("\n")
+        if line == "\\.":
+            break
+        fields = line.split("\t")
+        assert len(fields) == len(types), "Expected {} fields, got {}".format(len(types), len(fields))
+        yield [parse_copy_text(field, type_) for field, type_ in zip(fields, types)]
+
+def read_copy_binary(istream, types):
+    """
+    Reads rows in the COPY binary format from a binary stream.
+    """
+    def read(n):
+        data = istream.read(n)
+        assert len(data) == n, "Unexpected end of input"
+        return data
+
+    assert read(len(COPY_SIGNATURE)) == COPY_SIGNATURE, "Not in the COPY binary format"
+    _, ext_len = struct.unpack("!ii", read(8))
+    read(ext_len)
+    while True:
+        n_fields, = INT16.unpack(read(INT16.size))
+        if n_fields == -1:
+            break
+        assert n_fields == len(types), "Expected {} fields, got {}".format(len(types), n_fields)
+        row = []
+        for type_ in types:
+            length, = INT32.unpack(read(INT32.size))
+            row.append(None if length < 0 else decode_copy_binary(read(length), type_))
+        yield row
+
+def test_copy_text_roundtrip():
+    import io
+    types = ["int8", "int4", "text", "int4[]", "text[]"]
+    rows = [
+        [1, 2, "He said\t\"hi\"\\n", [1, 2, 3], ["a,b", 'c"d', "e\\f", None]],
+        [2, None, None, [], []],
+        ]
+    stream = io.StringIO()
+    writer = CopyTextWriter(stream, types)
+    for row in rows:
+        writer.writerow(row)
+    writer.close()
+    assert stream.getvalue().startswith('1\t2\tHe said\\t"hi"\\\\n\t{"1","2","3"}\t')
+    stream.seek(0)
+    assert list(read_copy_text(stream, types)) == rows
+
+def test_copy_binary_roundtrip():
+    import io
+    types = ["int8", "int4", "text", "int4[]", "text[]"]
+    rows = [
+        [1, 2, "He said\t\"hi\"\\n", [1, 2, 3], ["a,b", 'c"d', "e\\f", None]],
+        [2, None, None, [], []],
+        ]
+    stream = io.BytesIO()
+    writer = CopyBinaryWriter(stream, types, buffer_size=16)
+    for row in rows:
+        writer.writerow(row)
+    writer.close()
+    assert stream.getvalue().startswith(COPY_SIGNATURE)
+    assert stream.getvalue().endswith(INT16.pack(-1))
+    stream.seek(0)
+    assert list(read_copy_binary(stream, types)) == rows
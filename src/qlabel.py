@@ -5,7 +5,9 @@ The QuickLabel entry point
 """
 
 from __future__ import division
+import sys
 import csv
+import time
 from itertools import islice
 from collections import namedtuple
 from configparser import ConfigParser
@@ -13,9 +15,12 @@ from configparser import ConfigParser
 from crf import CRF
 from edit_shell import EditShell, QuitException
 from data_store import DataStore
+from model_registry import ModelRegistry
+from scheduler import RetrainScheduler
+from label_server import LabelServer, LabelClient, LeaseException
 from util import get_longest_span
 from tqdm import tqdm
-from pgutil import parse_psql_array, to_psql_array
+from pgutil import parse_psql_array, to_psql_array, CopyTextWriter, CopyBinaryWriter
 
 def grouper(iterable, n):
     "Collect data into fixed-length chunks or blocks"
@@ -48,14 +53,13 @@ def do_train(args):
     # Create the CRF model.
     model = CRF(config)
 
-    retrain_epochs = config["training"].getint("retrain_every")
+    scheduler = RetrainScheduler(config)
 
     accuracy = []
 
     with EditShell(config) as shell:
         while data.has_next():
             conll = data.next()
-            i = data.i()
 
             # if the data doesn't have tags, try to smart-tag them.
             if len(conll[0]) == DataStore.TAG_LABEL+1:
@@ -84,13 +88,98 @@ def do_train(args):
                     accuracy.append(score(tags, tags_))
 
                     data.update(conll, tags_)
+                    scheduler.update(tags, tags_)
 
-                    if i % retrain_epochs == 0:
-                        model.retrain()
+                    if scheduler.should_retrain():
+                        scheduler.start()
+                        scheduler.retrain(model)
 
             except QuitException:
                 break
 
+    # Make sure the final model has seen all the labelled data.
+    scheduler.finish(model)
+
+def do_serve(args):
+    config = ConfigParser()
+    config.read_file(args.config)
+
+    server = LabelServer(config)
+    print("Serving {} sentences at {}:{}".format(len(server.data), *server.address))
+    server.serve_forever()
+
+def lease_sentence(client, index, skipped):
+    """
+    Lease the sentence at @index, or the next free one that wasn't
+    skipped if that fails (e.g. because someone else is labelling it).
+    @return: the index and conll of the sentence, or None if nothing is left.
+    """
+    if index is not None:
+        try:
+            return client.lease(index, skipped)
+        except LeaseException:
+            pass
+    return client.lease(None, skipped)
+
+def do_connect(args):
+    config = ConfigParser()
+    config.read_file(args.config)
+
+    client = LabelClient(config)
+    default_tag = config['tags']['default']
+
+    # Sentences this client skipped, and the ones it has saved (for :prev).
+    skipped, history = set(), []
+    index = None
+    # Set if the server couldn't serve us, e.g. because CoreNLP is down.
+    error = None
+
+    with EditShell(config) as shell:
+        while True:
+            try:
+                sentence = lease_sentence(client, index, skipped)
+            except LeaseException as e:
+                error = e
+                break
+            if sentence is None:
+                break
+            index, conll = sentence
+
+            # if the data doesn't have tags, try to smart-tag them.
+            if len(conll[0]) == DataStore.TAG_LABEL+1:
+                tags = [tok[DataStore.TAG_LABEL] for tok in conll]
+            else:
+                tags = client.infer(conll) or [default_tag for _ in conll]
+
+            try:
+                conll_display = ["{}".format(token[0]) for token in conll]
+                action = shell.run(conll_display, list(tags), metadata=client.metadata)
+            except QuitException:
+                client.release(index)
+                break
+
+            if action.type == "save":
+                _, tags_ = action.args
+                try:
+                    client.save(index, conll, tags, tags_)
+                except LeaseException as e:
+                    error = e
+                    break
+                history.append(index)
+                index = None
+            else:
+                client.release(index)
+                if action.type == ":prev":
+                    index = history.pop() if len(history) > 0 else None
+                elif action.type == ":goto":
+                    index, = action.args
+                else:
+                    skipped.add(index)
+                    index = None
+    client.close()
+    if error is not None:
+        sys.exit("The server could not continue: {}".format(error))
+
 def reconstruct_gloss(sentence, token_begin, token_end):
     """
     Reconstruct a sentence gloss from a token span.
@@ -104,9 +193,16 @@ def reconstruct_gloss(sentence, token_begin, token_end):
             ret += " "
     return ret
 
-def extract_quote_entries(sentence, tags):
+def format_tokens(tokens):
+    """
+    Format a list of token indices as a postgres array.
+    """
+    return to_psql_array(map(str, tokens))
+
+def extract_quote_entries(sentence, tags, format_array=format_tokens):
     """
     Extract the quote entries from the sentence.
+    @format_array: how to format the list of content tokens.
     """
     # Parse the speaker tags.
     speaker_start, speaker_end = get_longest_span(tags, "SPKR")
@@ -125,7 +221,7 @@ def extract_quote_entries(sentence, tags):
 
     return [speaker_start, speaker_end,
             cue_start, cue_end,
-            content_start, content_end, to_psql_array(map(str,content_tokens)),
+            content_start, content_end, format_array(content_tokens),
             speaker, cue, content]
 
 def do_infer(args):
@@ -141,24 +237,103 @@ def do_infer(args):
     def parse_input(row):
         sentence = Sentence(*row)
         words, lemmas, pos_tags = [parse_psql_array(arr) for arr in (sentence.words, sentence.lemmas, sentence.pos_tags)]
-        return sentence._replace(words=words, lemmas=lemmas, pos_tags=pos_tags)
+        doc_char_begin, doc_char_end = [list(map(int, parse_psql_array(arr))) for arr in (sentence.doc_char_begin, sentence.doc_char_end)]
+        return sentence._replace(words=words, lemmas=lemmas, pos_tags=pos_tags, doc_char_begin=doc_char_begin, doc_char_end=doc_char_end)
 
-    writer = csv.writer(args.output, delimiter='\t')
-    writer.writerow([
-        'id',
-        'speaker_token_begin', 'speaker_token_end',
-        'cue_token_begin', 'cue_token_end',
-        'content_token_begin', 'content_token_end', 'content_tokens',
-        'speaker', 'cue', 'content'])
+    if args.output_format == "tsv":
+        writer = csv.writer(args.output, delimiter='\t')
+        writer.writerow([
+            'id',
+            'speaker_token_begin', 'speaker_token_end',
+            'cue_token_begin', 'cue_token_end',
+            'content_token_begin', 'content_token_end', 'content_tokens',
+            'speaker', 'cue', 'content'])
+        format_id, format_array = str, format_tokens
+    else:
+        # COPY output has no header and is typed.
+        types = [args.id_type] + ["int4"] * 6 + ["int4[]", "text", "text", "text"]
+        if args.output_format == "copy-text":
+            writer = CopyTextWriter(args.output, types)
+        else:
+            args.output.flush()
+            writer = CopyBinaryWriter(args.output.buffer, types)
+        format_id, format_array = (str if args.id_type == "text" else int), list
 
     for sentences in tqdm(grouper(map(parse_input, reader), args.batch_size)):
         conll = [zip(s.words, s.lemmas, s.pos_tags) for s in sentences]
         for sentence, tags in zip(sentences, model.infer(conll)):
             if "SPKR" not in tags or "CTNT" not in tags: continue
-            writer.writerow([sentence.id,] + extract_quote_entries(sentence, tags))
+            writer.writerow([format_id(sentence.id),] + extract_quote_entries(sentence, tags, format_array))
+
+    if args.output_format != "tsv":
+        writer.close()
+
+def do_models(args):
+    config = ConfigParser()
+    config.read_file(args.config)
+    registry = ModelRegistry(config)
+
+    if args.rollback:
+        meta = registry.rollback(args.rollback)
+        print("Activated and pinned model {}; use --unpin to use new models again".format(meta["fingerprint"]))
+        return
+    elif args.unpin:
+        meta = registry.unpin()
+        print("Activated model {}".format(meta["fingerprint"]))
+        return
+
+    active = registry.active()
+    writer = csv.writer(args.output, delimiter='\t')
+    writer.writerow(['active', 'fingerprint', 'created', 'train_time', 'sentences', 'size'])
+    for meta in registry.versions():
+        if meta["fingerprint"] != active["fingerprint"]:
+            state = ""
+        else:
+            state = "pinned" if active["pinned"] else "*"
+        writer.writerow([state, meta["fingerprint"],
+                         time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(meta["created"])),
+                         "{:.1f}".format(meta["train_time"]), meta["sentences"], meta["size"]])
+
+def test_lease_sentence():
+    """
+    Test that leasing falls back to the next free sentence, and that
+    errors after that are raised as LeaseException.
+    """
+    class Client(object):
+        def __init__(self, *replies):
+            self.replies = list(replies)
+            self.requests = []
+        def lease(self, index, skipped):
+            self.requests.append(index)
+            reply = self.replies.pop(0)
+            if isinstance(reply, Exception):
+                raise reply
+            return reply
+
+    client = Client((2, []))
+    assert lease_sentence(client, None, set()) == (2, [])
+    client = Client(LeaseException("Sentence 1 is being labelled by someone else"), (2, []))
+    assert lease_sentence(client, 1, set()) == (2, [])
+    assert client.requests == [1, None]
+    client = Client(LeaseException("taken"), LeaseException("CalledProcessError: curl failed"))
+    try:
+        lease_sentence(client, 1, set())
+        assert False
+    except LeaseException:
+        pass
+
+def test_extract_quote_entries():
+    Sentence = namedtuple('Sentence', ['words', 'doc_char_begin', 'doc_char_end'])
+    words = ['He', 'said', ',', '"', 'It', "'s", 'over', '.', '"']
+    doc_char_begin = [0, 3, 7, 9, 10, 12, 15, 19, 20]
+    doc_char_end = [2, 7, 8, 10, 12, 14, 19, 20, 21]
+    sentence = Sentence(words, doc_char_begin, doc_char_end)
+
+    tags = ["SPKR", "CUE", "O", "O", "CTNT", "CTNT", "CTNT", "CTNT", "O"]
+    assert extract_quote_entries(sentence, tags) == [0, 1, 1, 2, 4, 7, '{4,5,6,7}', "He", "said", "It's over"]
+    assert extract_quote_entries(sentence, tags, list)[6] == [4, 5, 6, 7]
 
 if __name__ == "__main__":
-    import sys
     import argparse
     parser = argparse.ArgumentParser(description='')
     parser.add_argument('--config', type=argparse.FileType('r'),  help="Path to configuration file")
@@ -167,13 +342,27 @@ if __name__ == "__main__":
     command_parser = subparsers.add_parser('train', help='Opens the training interface')
     command_parser.set_defaults(func=do_train)
 
+    command_parser = subparsers.add_parser('serve', help='Serves the training data to several annotators (see connect)')
+    command_parser.set_defaults(func=do_serve)
+
+    command_parser = subparsers.add_parser('connect', help='Opens the training interface on data served by serve')
+    command_parser.set_defaults(func=do_connect)
+
     command_parser = subparsers.add_parser('infer', help='Uses the trained model to evaluate new sentences')
     command_parser.add_argument('--batch_size', type=int, default=1000, help="Batch input to be sent to CRF.")
 
     command_parser.add_argument('--input', type=argparse.FileType('r'), default=sys.stdin, help="Input")
     #command_parser.add_argument('--has_annotations', action='store_true', default=False, help="Does the input have annotations?")
     command_parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout, help="Output")
+    command_parser.add_argument('--output_format', '--output-format', choices=['tsv', 'copy-text', 'copy-binary'], default='tsv', help="Output a TSV with a header, or rows for COPY ... FROM STDIN (FORMAT text|binary).")
+    command_parser.add_argument('--id_type', choices=['text', 'int4', 'int8'], default='text', help="Type of the id column for COPY output.")
     command_parser.set_defaults(func=do_infer)
 
+    command_parser = subparsers.add_parser('models', help='Lists trained model versions (marking the active one) or rolls back to an older one')
+    command_parser.add_argument('--rollback', type=int, default=0, help="Activate the model trained this many versions before the active one, and keep it until --unpin.")
+    command_parser.add_argument('--unpin', action='store_true', default=False, help="Activate the newest model, and let retrains replace it again.")
+    command_parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout, help="Output")
+    command_parser.set_defaults(func=do_models)
+
     ARGS = parser.parse_args()
     ARGS.func(ARGS)
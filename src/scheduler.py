@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Decides when to retrain the CRF.
+"""
+
+import time
+import threading
+
+class RetrainScheduler(object):
+    """
+    Schedules retrains so that the time spent in crf_learn stays within a
+    fraction of the time spent labelling. The fraction grows (up to
+    twice [training] retrain_budget) with the fraction of tags that the
+    model got wrong in the examples saved since the last retrain.
+
+    If [training] retrain_budget is not set, falls back to retraining
+    every [training] retrain_every labelled examples.
+
+    If the model only trains on a window of the data, it is also retrained
+    on all of it in the background every [training] full_retrain_every
+    retrains.
+    """
+
+    def __init__(self, config):
+        self.budget = config.getfloat("training", "retrain_budget", fallback=None)
+        self.retrain_every = config.getint("training", "retrain_every", fallback=1)
+
+        # Measured cost of the last retrain (in seconds).
+        self.last_cost = 0.
+        # When the last retrain finished.
+        self.last_retrain = time.time()
+        # Number of examples saved / tags saved / tags changed since the
+        # last retrain.
+        self.pending_examples = 0
+        self.pending_tags = 0
+        self.pending_labels = 0
+        self.saves = 0
+
+        self.full_retrain_every = config.getint("training", "full_retrain_every", fallback=10)
+        # Number of windowed retrains since the last full one started.
+        self.partial_retrains = 0
+        self.full_thread = None
+
+    def update(self, guess, gold):
+        """
+        Record a saved example, with the tags @guess proposed by the
+        model and the tags @gold actually saved.
+        """
+        self.saves += 1
+        self.pending_examples += 1
+        self.pending_tags += len(gold)
+        self.pending_labels += sum(1 for tag, tag_ in zip(guess, gold) if tag != tag_)
+
+    def should_retrain(self):
+        """
+        Returns true if the model should be retrained now.
+        """
+        if self.pending_examples == 0:
+            return False
+        if self.budget is None:
+            return self.saves % self.retrain_every == 0
+        return self.last_cost <= self.budget * self.weight() * (time.time() - self.last_retrain)
+
+    def weight(self):
+        """
+        How much of the budget may be spent on the next retrain: 1 if
+        the model got every pending tag right, up to 2 if it got them all
+        wrong.
+        """
+        if self.pending_tags == 0:
+            return 1.
+        return 1. + self.pending_labels / self.pending_tags
+
+    def start(self):
+        """
+        Record that a retrain is starting; examples saved from now on
+        count towards the next retrain.
+        """
+        self.pending_examples = 0
+        self.pending_tags = 0
+        self.pending_labels = 0
+
+    def record(self, cost):
+        """
+        Record that a retrain just finished and took @cost seconds.
+        """
+        self.last_cost = cost
+        self.last_retrain = time.time()
+
+    def retrain(self, model, callback=None, **kwargs):
+        """
+        Retrain @model on a window of the data and record how long it took.
+        Call start() first, when the data to train on is fixed.
+        @callback: called when a background full retrain has finished.
+        """
+        start = time.time()
+        # If the model was already in the registry, this only took a copy.
+        if model.retrain(full=False, **kwargs):
+            self.record(time.time() - start)
+
+        if model.window is not None:
+            self.partial_retrains += 1
+            if self.partial_retrains >= self.full_retrain_every:
+                self.retrain_full(model, callback, **kwargs)
+
+    def retrain_full(self, model, callback=None, train_path=None):
+        """
+        Retrain @model on all the data in the background, unless a full
+        retrain is already running.
+        """
+        if self.full_thread is not None and self.full_thread.is_alive():
+            return False
+        # Compact here so that the data can't change while we read it.
+        path = model.compact(train_path, full=True)
+        self.partial_retrains = 0
+
+        def run():
+            # Use the full model as soon as it is ready; the next windowed
+            # retrain picks up whatever was labelled in the meantime.
+            model.train(path)
+            if callback is not None:
+                callback()
+        self.full_thread = threading.Thread(target=run, daemon=True)
+        self.full_thread.start()
+        return True
+
+    def finish(self, model, train_path=None):
+        """
+        Waits for any background retrain, and makes sure that the final
+        model has been trained on all the data.
+        """
+        if self.full_thread is not None:
+            self.full_thread.join()
+        if self.partial_retrains > 0 or self.pending_examples > 0:
+            self.start()
+            model.retrain(train_path, full=True)
+            self.partial_retrains = 0
+
+def test_scheduler():
+    """
+    Test that retrains are spaced out by their cost.
+    """
+    from configparser import ConfigParser
+    config = ConfigParser()
+    config.read_dict({"training": {"retrain_budget": "0.5"}})
+    scheduler = RetrainScheduler(config)
+
+    # Cheap retrains happen after every new example.
+    assert not scheduler.should_retrain()
+    scheduler.update(["O", "O"], ["O", "SPKR"])
+    assert scheduler.should_retrain()
+    scheduler.start()
+    scheduler.record(0.)
+    # ... even if the model already got everything right.
+    scheduler.update(["O", "O"], ["O", "O"])
+    assert scheduler.should_retrain()
+
+    # Expensive retrains wait until enough labelling time has passed...
+    scheduler.start()
+    scheduler.record(10.)
+    scheduler.update(["O", "O"], ["O", "O"])
+    assert not scheduler.should_retrain()
+    scheduler.last_retrain -= 15.
+    assert not scheduler.should_retrain()
+    # ... which is shorter if the model got more tags wrong.
+    scheduler.update(["O", "O"], ["SPKR", "SPKR"])
+    assert scheduler.weight() == 1.5
+    assert scheduler.should_retrain()
+
+def test_scheduler_fixed():
+    """
+    Test the fallback to a fixed schedule.
+    """
+    from configparser import ConfigParser
+    config = ConfigParser()
+    config.read_dict({"training": {"retrain_every": "2"}})
+    scheduler = RetrainScheduler(config)
+
+    scheduler.update(["O"], ["O"])
+    assert not scheduler.should_retrain()
+    scheduler.update(["O"], ["O"])
+    assert scheduler.should_retrain()
+
+def test_scheduler_full():
+    """
+    Test that windowed retrains are followed by full ones.
+    """
+    from configparser import ConfigParser
+    config = ConfigParser()
+    config.read_dict({"training": {"full_retrain_every": "2"}})
+    scheduler = RetrainScheduler(config)
+
+    class Model(object):
+        window = 10
+        def __init__(self):
+            self.trained = []
+        def retrain(self, train_path=None, full=True):
+            self.trained.append(full)
+            return True
+        def compact(self, train_path=None, full=True):
+            return full
+        def train(self, full):
+            self.trained.append(full)
+
+    model = Model()
+    for _ in range(3):
+        scheduler.retrain(model)
+        scheduler.full_thread and scheduler.full_thread.join()
+    assert model.trained == [False, False, True, False]
+    scheduler.finish(model)
+    assert model.trained == [False, False, True, False, True]
+    # Examples saved since the last retrain are trained on too.
+    scheduler.finish(model)
+    assert len(model.trained) == 5
+    scheduler.update(["O"], ["O"])
+    scheduler.finish(model)
+    assert model.trained == [False, False, True, False, True, True]
+
+def test_scheduler_cached():
+    """
+    Test that retrains served from the model registry don't count as cheap.
+    """
+    from configparser import ConfigParser
+    config = ConfigParser()
+    config.read_dict({"training": {"retrain_budget": "0.5"}})
+    scheduler = RetrainScheduler(config)
+    scheduler.record(10.)
+
+    class Model(object):
+        window = None
+        def retrain(self, train_path=None, full=True):
+            return False
+
+    scheduler.last_retrain -= 20.
+    scheduler.update(["O"], ["SPKR"])
+    scheduler.start()
+    scheduler.retrain(Model())
+    assert scheduler.last_cost == 10.
+    scheduler.update(["O"], ["SPKR"])
+    assert scheduler.should_retrain()
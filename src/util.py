@@ -2,7 +2,6 @@
 # -*- coding: utf-8 -*-
 """
 """
-import ipdb
 from urllib.parse import urlencode
 from urllib.request import quote
 import subprocess
@@ -10,36 +9,37 @@ import csv
 import json
 from settings import SERVER_URI
 
-def parse_conll(reader):
+def iter_conll(lines):
     """
-    Parses a file in CONLL input, i.e.
-    'TOKEN(<TAB>FEAT)+' for each token in a sentence, followed by a new line.
+    Parses CONLL from an iterable of lines (e.g. a file), yielding a
+    list of fields for every token in a sentence at a time.
     """
-    current = []
-    for row in reader:
-        # Handling.
-        if len(row) == 0:
-            if len(current)> 0:
-                yield current
-            current = []
+    cur = []
+    for line in lines:
+        line = line.rstrip("\n")
+        if len(line) == 0:
+            if len(cur) > 0:
+                yield cur
+            cur = []
         else:
-            current.append(row)
-        # End logic
-    if len(current) > 0:
-        yield current
+            cur.append(line.split("\t"))
+    if len(cur) > 0:
+        yield cur
+
+def iter_lines(blob):
+    """
+    Iterates over the lines in @blob without splitting the whole string.
+    """
+    pos, end = 0, len(blob)
+    while pos < end:
+        nl = blob.find("\n", pos)
+        if nl < 0:
+            nl = end
+        yield blob[pos:nl]
+        pos = nl+1
 
 def read_conll_doc(blob):
-    ret = []
-    cur = []
-    for toks in blob.split("\n"):
-        if len(toks) == 0 and len(cur) > 0:
-            ret.append(cur)
-            cur = []
-        elif len(toks) > 0:
-            feats = toks.split("\t")
-            assert len(feats)
-            cur.append(feats)
-    return ret
+    return list(iter_conll(iter_lines(blob)))
 
 def sentence_to_conll(ostream, sentence):
     """
@@ -57,7 +57,11 @@ def write_conll(ostream, conll):
     """
     Output sentence to conll format
     """
-    ostream.writelines(['\t'.join(fields) + "\n" for fields in conll] + ["\n"])
+    write = ostream.write
+    for fields in conll:
+        write('\t'.join(fields))
+        write("\n")
+    write("\n")
 
 def __call_server(doc, props, uri=SERVER_URI):
     """
@@ -120,3 +124,19 @@ def get_longest_span(lst, item):
 
     return begin, end
 
+
+def test_iter_conll():
+    import io
+    import tempfile
+    doc = "a\tDT\tO\nb\tNN\tSPKR\n\n\nc\tVB\tO\n\n"
+    conll = [[["a", "DT", "O"], ["b", "NN", "SPKR"]], [["c", "VB", "O"]]]
+    assert list(iter_conll(io.StringIO(doc))) == conll
+    assert read_conll_doc(doc) == conll
+    assert read_conll_doc(doc.rstrip("\n")) == conll
+
+    with tempfile.NamedTemporaryFile("w", suffix=".conll") as f:
+        for conll_ in conll:
+            write_conll(f, conll_)
+        f.flush()
+        with open(f.name) as f_:
+            assert list(iter_conll(f_)) == conll